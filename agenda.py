@@ -0,0 +1,182 @@
+"""Utilidades puras de horarios para app.py.
+
+Streamlit re-ejecuta app.py en un módulo nuevo en cada rerun, así que las
+lru_cache definidas allí se pierden. Este módulo se importa una sola vez por
+proceso y sus caches sí sobreviven entre reruns y sesiones.
+"""
+
+import os
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple, Union
+from zoneinfo import ZoneInfo
+
+import ciso8601
+import holidays
+from dotenv import load_dotenv
+
+# Se importa antes de que app.py cargue el .env; TZ puede venir de ahí.
+load_dotenv()
+
+SLOT_MINUTES = 15
+MORNING_START_HOUR = 8
+MORNING_END_HOUR = 12
+AFTERNOON_START_HOUR = 14
+AFTERNOON_END_HOUR = 18
+_MORNING_START_MIN = MORNING_START_HOUR * 60
+_MORNING_END_MIN = MORNING_END_HOUR * 60
+_AFTERNOON_START_MIN = AFTERNOON_START_HOUR * 60
+_AFTERNOON_END_MIN = AFTERNOON_END_HOUR * 60
+# Horas de inicio de cada slot; iguales para todos los días.
+SLOT_TIMES = tuple(
+    time(hour=minute // 60, minute=minute % 60)
+    for first, last in (
+        (_MORNING_START_MIN, _MORNING_END_MIN),
+        (_AFTERNOON_START_MIN, _AFTERNOON_END_MIN),
+    )
+    for minute in range(first, last, SLOT_MINUTES)
+)
+SLOTS_PER_DAY = len(SLOT_TIMES)
+
+
+def get_timezone() -> ZoneInfo:
+    tz_name = os.getenv("TZ", "America/Bogota")
+    return ZoneInfo(tz_name)
+
+
+tz = get_timezone()
+
+
+@lru_cache(maxsize=None)
+def _holiday_ordinals(year: int) -> frozenset:
+    """Festivos de Colombia del año como date.toordinal()."""
+
+    return frozenset(
+        day.toordinal() for day in holidays.country_holidays("CO", years=[year])
+    )
+
+
+def holiday_ordinals_between(start: date, end: date) -> frozenset:
+    return frozenset().union(
+        *(_holiday_ordinals(year) for year in range(start.year, end.year + 1))
+    )
+
+
+def is_blocked_date(day: date) -> bool:
+    # Sunday or Colombia public holiday.
+    return day.weekday() == 6 or day.toordinal() in _holiday_ordinals(day.year)
+
+
+@lru_cache(maxsize=8)
+def date_skeleton(start: date, days: int) -> Tuple[Tuple[date, str], ...]:
+    """(día, motivo de bloqueo por calendario) para la ventana; no depende de citas."""
+
+    first = start.toordinal()
+    holiday_set = holiday_ordinals_between(start, start + timedelta(days=days))
+    skeleton = []
+    for ordinal in range(first, first + days + 1):
+        day = date.fromordinal(ordinal)
+        if day.weekday() == 6:
+            skeleton.append((day, "domingo"))
+        elif ordinal in holiday_set:
+            skeleton.append((day, "festivo"))
+        else:
+            skeleton.append((day, ""))
+    return tuple(skeleton)
+
+
+@lru_cache(maxsize=128)
+def generate_slots_for_date(selected_date: date) -> Tuple[datetime, ...]:
+    """Slots del día; se devuelve una tupla porque el resultado es compartido."""
+
+    return tuple(
+        datetime.combine(selected_date, slot_time, tzinfo=tz)
+        for slot_time in SLOT_TIMES
+    )
+
+
+def slot_key(dt_value: datetime) -> str:
+    return dt_value.replace(second=0, microsecond=0).isoformat()
+
+
+def parse_iso_datetime(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    return _parse_iso_cached(value)
+
+
+@lru_cache(maxsize=4096)
+def _parse_iso_cached(value: str) -> Optional[datetime]:
+    # Los datetime son inmutables, así que el resultado se puede compartir.
+    try:
+        dt_val = ciso8601.parse_datetime(value)
+    except ValueError:
+        return None
+    if dt_val.tzinfo is None:
+        dt_val = dt_val.replace(tzinfo=tz)
+    return dt_val.astimezone(tz)
+
+
+@lru_cache(maxsize=512)
+def _utc_offset_suffix(day: date) -> str:
+    return datetime.combine(day, SLOT_TIMES[0], tzinfo=tz).isoformat()[19:]
+
+
+def conflict_stamp(raw_iso: str, day: date) -> str:
+    """Llave de minuto de una cita en el mismo formato que slot_key()."""
+
+    # Lo que escribe la app ya es canónico (YYYY-MM-DDTHH:MM:00-05:00).
+    if (
+        len(raw_iso) == 25
+        and raw_iso[10] == "T"
+        and raw_iso[16:19] == ":00"
+        and raw_iso[19:] == _utc_offset_suffix(day)
+    ):
+        return raw_iso
+    dt_val = parse_iso_datetime(raw_iso)
+    if dt_val:
+        return slot_key(dt_val)
+    return f"{raw_iso[:10]}T{raw_iso[11:16]}"
+
+
+def format_clock(dt_value: Union[datetime, time]) -> str:
+    """Equivale a strftime("%I:%M %p") sin pasar por strftime."""
+
+    hour = dt_value.hour
+    return f"{hour % 12 or 12:02d}:{dt_value.minute:02d} {'AM' if hour < 12 else 'PM'}"
+
+
+class Slot(NamedTuple):
+    dt: datetime
+    status: str
+    label: str
+
+
+# (libre, ocupada) por cada hora de SLOT_TIMES; las etiquetas no dependen del día.
+_SLOT_LABELS = tuple(
+    (f"🟢 {clock}", f"🔴 {clock} (ocupada)") for clock in map(format_clock, SLOT_TIMES)
+)
+
+
+@lru_cache(maxsize=256)
+def slot_options(selected_date: date, conflicts: frozenset) -> Tuple[Slot, ...]:
+    """Opciones del selectbox; se reutilizan mientras la agenda del día no cambie."""
+
+    data: List[Slot] = []
+    for slot, (free_label, busy_label) in zip(
+        generate_slots_for_date(selected_date), _SLOT_LABELS
+    ):
+        if slot_key(slot) in conflicts:
+            data.append(Slot(slot, "busy", busy_label))
+        else:
+            data.append(Slot(slot, "free", free_label))
+    return tuple(data)
+
+
+def is_within_business_hours(dt_value: datetime) -> bool:
+    total = dt_value.hour * 60 + dt_value.minute
+    return (
+        _MORNING_START_MIN <= total < _MORNING_END_MIN
+        or _AFTERNOON_START_MIN <= total < _AFTERNOON_END_MIN
+        or (total == _AFTERNOON_END_MIN and dt_value.second == 0)
+    )
@@ -1,18 +1,17 @@
 import os
 import json
+import logging
 import uuid
 import smtplib
 import ssl
 import re
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 from datetime import datetime, date, time, timedelta
-from zoneinfo import ZoneInfo
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-import pandas as pd
-import pytz
 import streamlit as st
-import holidays
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
@@ -21,9 +20,31 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 
+from agenda import (
+    SLOT_MINUTES,
+    SLOTS_PER_DAY,
+    Slot,
+    conflict_stamp,
+    date_skeleton,
+    format_clock,
+    is_within_business_hours,
+    slot_key,
+    slot_options,
+    tz,
+)
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+SPREADSHEET_ID = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
+CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID", "primary")
+GMAIL_USER = os.getenv("GMAIL_USER", "")
+GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD", "")
+
 SHEET_NAME = "Appointments"
+APPOINTMENTS_RANGE = f"{SHEET_NAME}!A2:L"
+LOOKUP_COLUMNS = ["id", "local_display", "status", "notes"]
 HEADERS = [
     "id",
     "name",
@@ -38,67 +59,37 @@ HEADERS = [
     "created_at_iso",
     "notes",
 ]
-SLOT_MINUTES = 15
-MORNING_START_HOUR = 8
-MORNING_END_HOUR = 12
-AFTERNOON_START_HOUR = 14
-AFTERNOON_END_HOUR = 18
 DEFAULT_DURATION_MINUTES = SLOT_MINUTES
+BOOKING_WINDOW_DAYS = 120
 SCOPES = [
     "https://www.googleapis.com/auth/calendar",
     "https://www.googleapis.com/auth/spreadsheets",
 ]
 DISABLE_ATTENDEE_INVITES = os.getenv("DISABLE_ATTENDEE_INVITES", "1") == "1"
+FETCH_TTL_SECONDS = 30
+SMTP_HOST = "smtp.gmail.com"
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+_PHONE_RE = re.compile(r"3\d{9}")
 
 
-def get_timezone() -> ZoneInfo:
-    tz_name = os.getenv("TZ", "America/Bogota")
-    return ZoneInfo(tz_name)
-
-
-tz = get_timezone()
-
-
-def build_holiday_range_set(start: date, end: date) -> set:
-    years = list(range(start.year, end.year + 1))
-    co_holidays = holidays.country_holidays("CO", years=years)
-    return set(co_holidays.keys())
+def validate_config() -> None:
+    if not SPREADSHEET_ID:
+        raise ValueError("Falta GOOGLE_SHEETS_SPREADSHEET_ID")
 
 
-def is_blocked_date(day: date) -> bool:
-    # Sunday or Colombia public holiday.
-    if day.weekday() == 6:
-        return True
-    # quick range covering the day year
-    holiday_set = build_holiday_range_set(day, day)
-    return day in holiday_set
+TZ_NAME = str(tz)
 
 
 def date_choice_list(
-    start: date,
-    existing: List[Dict],
-    days: int = 120,
-    ignore_id: Optional[str] = None,
+    start: date, index: Dict[date, set], days: int = BOOKING_WINDOW_DAYS
 ) -> Tuple[List[Dict], int]:
-    end = start + timedelta(days=days)
-    holiday_set = build_holiday_range_set(start, end)
+    # Cada día es una búsqueda en el índice de index_appointments().
     choices: List[Dict] = []
     default_index = 0
-    for i in range(days + 1):
-        day = start + timedelta(days=i)
-        is_sunday = day.weekday() == 6
-        is_holiday = day in holiday_set
-        is_full = day_is_full(existing, day, ignore_id)
-        blocked = is_sunday or is_holiday or is_full
-        reason = (
-            "domingo"
-            if is_sunday
-            else "festivo"
-            if is_holiday
-            else "agenda completa"
-            if is_full
-            else ""
-        )
+    for day, calendar_reason in date_skeleton(start, days):
+        is_full = not calendar_reason and day_is_full(index, day)
+        blocked = bool(calendar_reason) or is_full
+        reason = calendar_reason or ("agenda completa" if is_full else "")
         label = (
             f"🔴 {day.isoformat()} ({reason})" if blocked else f"🟢 {day.isoformat()}"
         )
@@ -119,32 +110,19 @@ def now_local() -> datetime:
 def is_valid_email(value: str) -> bool:
     if not value:
         return False
-    pattern = r"^[^@\s]+@[^@\s]+\.[^@\s]+$"
-    return bool(re.match(pattern, value.strip()))
+    return _EMAIL_RE.match(value.strip()) is not None
 
 
 def is_valid_phone_co(value: str) -> bool:
     if not value:
         return False
-    return bool(re.fullmatch(r"3\d{9}", value.strip()))
+    return _PHONE_RE.fullmatch(value.strip()) is not None
 
 
 def combine_datetime(selected_date: date, selected_time: time) -> datetime:
     return datetime.combine(selected_date, selected_time, tzinfo=tz)
 
 
-def parse_iso_datetime(value: str) -> Optional[datetime]:
-    if not value:
-        return None
-    try:
-        dt_val = datetime.fromisoformat(value)
-        if dt_val.tzinfo is None:
-            dt_val = dt_val.replace(tzinfo=tz)
-        return dt_val.astimezone(tz)
-    except ValueError:
-        return None
-
-
 def parse_google_datetime(value: str) -> Optional[datetime]:
     if not value:
         return None
@@ -155,62 +133,48 @@ def parse_google_datetime(value: str) -> Optional[datetime]:
         return None
 
 
-def generate_slots_for_date(selected_date: date) -> List[datetime]:
-    slots: List[datetime] = []
+def index_appointments(
+    existing: List[Dict], ignore_id: Optional[str] = None
+) -> Dict[date, set]:
+    """Agrupa en una sola pasada los horarios ocupados por fecha."""
 
-    morning_start = datetime.combine(
-        selected_date, time(hour=MORNING_START_HOUR, minute=0), tzinfo=tz
-    )
-    morning_end = datetime.combine(
-        selected_date, time(hour=MORNING_END_HOUR, minute=0), tzinfo=tz
-    )
-    afternoon_start = datetime.combine(
-        selected_date, time(hour=AFTERNOON_START_HOUR, minute=0), tzinfo=tz
-    )
-    afternoon_end = datetime.combine(
-        selected_date, time(hour=AFTERNOON_END_HOUR, minute=0), tzinfo=tz
-    )
-
-    current = morning_start
-    while current < morning_end:
-        slots.append(current)
-        current += timedelta(minutes=SLOT_MINUTES)
-
-    current = afternoon_start
-    while current < afternoon_end:
-        slots.append(current)
-        current += timedelta(minutes=SLOT_MINUTES)
-
-    return slots
-
-
-def build_conflict_set(
-    existing: List[Dict], selected_date: date, ignore_id: Optional[str] = None
-) -> set:
-    conflicts = set()
+    index: Dict[date, set] = {}
     for item in existing:
         if item.get("status") != "active":
             continue
         if ignore_id and item.get("id") == ignore_id:
             continue
         raw_iso = item.get("start_time_iso", "")
-        dt_val = parse_iso_datetime(raw_iso)
-        item_date = dt_val.date() if dt_val else None
-        # Fallback: compare by date prefix if parse fails
-        if item_date is None and len(raw_iso) >= 10:
-            try:
-                item_date = datetime.fromisoformat(raw_iso[:10]).date()
-            except ValueError:
-                item_date = None
-
-        if item_date and item_date == selected_date:
-            stamp = (
-                dt_val.replace(second=0, microsecond=0).isoformat()
-                if dt_val
-                else f"{selected_date.isoformat()}T{raw_iso[11:16]}"
-            )
-            conflicts.add(stamp)
-    return conflicts
+        try:
+            item_date = date.fromisoformat(raw_iso[:10])
+        except ValueError:
+            continue
+        index.setdefault(item_date, set()).add(conflict_stamp(raw_iso, item_date))
+    return index
+
+
+class AppointmentsIndex(NamedTuple):
+    rows: List[Dict]
+    by_date: Dict[date, set]
+    # id -> posición en rows; la posición + 2 es la fila en la hoja.
+    by_id: Dict[str, int]
+    by_email: Dict[str, List[Dict]]
+
+
+def build_appointments_index(existing: List[Dict]) -> AppointmentsIndex:
+    """Construye todos los índices de búsqueda en una sola pasada extra."""
+
+    by_id: Dict[str, int] = {}
+    by_email: Dict[str, List[Dict]] = {}
+    for idx, item in enumerate(existing):
+        by_id.setdefault(item.get("id", ""), idx)
+        by_email.setdefault(item.get("email", "").casefold(), []).append(item)
+    return AppointmentsIndex(
+        rows=existing,
+        by_date=index_appointments(existing),
+        by_id=by_id,
+        by_email=by_email,
+    )
 
 
 def calendar_has_conflict(
@@ -221,14 +185,13 @@ def calendar_has_conflict(
 ) -> bool:
     """Verifica conflictos directos en Calendar para el slot indicado."""
 
-    calendar_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
     window_start = start_dt - timedelta(minutes=duration_minutes)
     window_end = start_dt + timedelta(minutes=duration_minutes)
 
     events = (
         calendar_service.events()
         .list(
-            calendarId=calendar_id,
+            calendarId=CALENDAR_ID,
             timeMin=window_start.isoformat(),
             timeMax=window_end.isoformat(),
             singleEvents=True,
@@ -255,45 +218,36 @@ def calendar_has_conflict(
     return False
 
 
-def day_is_full(
-    existing: List[Dict], selected_date: date, ignore_id: Optional[str] = None
-) -> bool:
-    slots_in_day = len(generate_slots_for_date(selected_date))
-    conflicts = build_conflict_set(existing, selected_date, ignore_id)
-    return len(conflicts) >= slots_in_day
-
-
-def slot_choices(
-    existing: List[Dict], selected_date: date, ignore_id: Optional[str] = None
-) -> List[Dict]:
-    slots = generate_slots_for_date(selected_date)
-    conflicts = build_conflict_set(existing, selected_date, ignore_id)
-    data: List[Dict] = []
-    for slot in slots:
-        iso_slot = slot.replace(second=0, microsecond=0).isoformat()
-        is_busy = iso_slot in conflicts
-        label = (
-            f"🔴 {slot.strftime('%I:%M %p')} (ocupada)"
-            if is_busy
-            else f"🟢 {slot.strftime('%I:%M %p')}"
-        )
-        data.append(
-            {"dt": slot, "status": "busy" if is_busy else "free", "label": label}
-        )
-    return data
+def day_is_full(index: Dict[date, set], selected_date: date) -> bool:
+    return len(index.get(selected_date, ())) >= SLOTS_PER_DAY
 
 
-def is_within_business_hours(dt_value: datetime) -> bool:
-    in_morning = MORNING_START_HOUR <= dt_value.hour < MORNING_END_HOUR
-    in_afternoon = AFTERNOON_START_HOUR <= dt_value.hour < AFTERNOON_END_HOUR
-    at_exact_end = (
-        dt_value.hour == AFTERNOON_END_HOUR
-        and dt_value.minute == 0
-        and dt_value.second == 0
-    )
-    return in_morning or in_afternoon or at_exact_end
+def slot_choices(index: Dict[date, set], selected_date: date) -> Tuple[Slot, ...]:
+    return slot_options(selected_date, frozenset(index.get(selected_date, ())))
+
 
+def save_token(token_file: str, creds: Credentials) -> None:
+    """Guarda el token de forma atómica y solo si cambió.
 
+    Es best-effort: si el disco falla, las credenciales ya obtenidas siguen sirviendo.
+    """
+
+    payload = creds.to_json()
+    try:
+        if os.path.exists(token_file):
+            with open(token_file, encoding="utf-8") as fh:
+                if fh.read() == payload:
+                    return
+        os.makedirs(os.path.dirname(token_file) or ".", exist_ok=True)
+        tmp_file = f"{token_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fh:
+            fh.write(payload)
+        os.replace(tmp_file, token_file)
+    except OSError:
+        logger.exception("No se pudo guardar el token OAuth en %s", token_file)
+
+
+@st.cache_resource(show_spinner=False)
 def load_user_credentials() -> Credentials:
     """Obtiene credenciales: usa service account si está configurada, si no flujo OAuth."""
 
@@ -301,6 +255,7 @@ def load_user_credentials() -> Credentials:
     sa_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     oauth_file = os.getenv("GOOGLE_OAUTH_CLIENT_FILE")
     oauth_json = os.getenv("GOOGLE_OAUTH_CLIENT_JSON")
+    token_file = os.getenv("GOOGLE_OAUTH_TOKEN_FILE", ".streamlit/oauth_token.json")
 
     if sa_json or sa_file:
         try:
@@ -317,6 +272,25 @@ def load_user_credentials() -> Credentials:
                 "GOOGLE_SERVICE_ACCOUNT_JSON/FILE no es válido o no se pudo cargar"
             ) from exc
 
+    creds = None
+    if os.path.exists(token_file):
+        try:
+            creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+        except ValueError:
+            # Token corrupto o incompleto: se trata como uno revocado.
+            logger.warning("Token OAuth inválido en %s; se repite el flujo", token_file)
+    if creds:
+        if creds.valid:
+            return creds
+        if creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+            except RefreshError:
+                creds = None
+            if creds and creds.valid:
+                save_token(token_file, creds)
+                return creds
+
     client_config: Optional[Dict] = None
     if oauth_json:
         try:
@@ -336,6 +310,7 @@ def load_user_credentials() -> Credentials:
     )
     # En cloud no hay navegador; este flujo es útil solo local. Preferir service account en despliegue.
     creds = flow.run_local_server(port=0)
+    save_token(token_file, creds)
     return creds
 
 
@@ -347,30 +322,35 @@ def get_google_services():
     return calendar, sheets
 
 
-def ensure_sheet_headers(sheets_service) -> None:
-    spreadsheet_id = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
-    if not spreadsheet_id:
-        raise ValueError("Falta GOOGLE_SHEETS_SPREADSHEET_ID")
+@st.cache_resource(show_spinner=False)
+def get_email_executor() -> ThreadPoolExecutor:
+    # Un solo hilo: es lo que serializa el uso de la conexión SMTP de _smtp_conn.
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+
+
+@st.cache_resource(show_spinner=False)
+def ensure_sheet_headers(_sheets_service) -> None:
+    """Verifica los encabezados una vez por proceso (se cachea solo si no falla)."""
 
     try:
         current = (
-            sheets_service.spreadsheets()
+            _sheets_service.spreadsheets()
             .values()
-            .get(spreadsheetId=spreadsheet_id, range=f"{SHEET_NAME}!1:1")
+            .get(spreadsheetId=SPREADSHEET_ID, range=f"{SHEET_NAME}!1:1")
             .execute()
         )
         values = current.get("values", [])
         if not values or values[0] != HEADERS:
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
+            _sheets_service.spreadsheets().values().update(
+                spreadsheetId=SPREADSHEET_ID,
                 range=f"{SHEET_NAME}!1:1",
                 valueInputOption="RAW",
                 body={"values": [HEADERS]},
             ).execute()
     except HttpError as exc:
         if exc.resp.status == 400:
-            sheets_service.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id,
+            _sheets_service.spreadsheets().batchUpdate(
+                spreadsheetId=SPREADSHEET_ID,
                 body={
                     "requests": [
                         {
@@ -383,8 +363,8 @@ def ensure_sheet_headers(sheets_service) -> None:
                     ]
                 },
             ).execute()
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
+            _sheets_service.spreadsheets().values().update(
+                spreadsheetId=SPREADSHEET_ID,
                 range=f"{SHEET_NAME}!1:1",
                 valueInputOption="RAW",
                 body={"values": [HEADERS]},
@@ -393,61 +373,168 @@ def ensure_sheet_headers(sheets_service) -> None:
             raise
 
 
-def fetch_appointments(sheets_service) -> List[Dict]:
-    spreadsheet_id = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
-    if not spreadsheet_id:
-        return []
+def batch_get_values(sheets_service, ranges: List[str]) -> List[List[List[str]]]:
+    """Lee varios rangos en una sola llamada; devuelve las filas en el mismo orden."""
 
-    ensure_sheet_headers(sheets_service)
     result = (
         sheets_service.spreadsheets()
         .values()
-        .get(spreadsheetId=spreadsheet_id, range=f"{SHEET_NAME}!A2:L")
+        .batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=ranges,
+            majorDimension="ROWS",
+            # Respuesta parcial: solo las celdas, sin metadatos de cada rango.
+            fields="valueRanges(values)",
+        )
         .execute()
     )
-    rows = result.get("values", [])
-    data: List[Dict] = []
-    for row in rows:
-        item = {
-            key: (row[idx] if idx < len(row) else "") for idx, key in enumerate(HEADERS)
-        }
-        data.append(item)
-    return data
+    value_ranges = result.get("valueRanges", [])
+    return [
+        value_ranges[idx].get("values", []) if idx < len(value_ranges) else []
+        for idx in range(len(ranges))
+    ]
 
 
-def append_appointment(sheets_service, values: List[str]) -> None:
-    spreadsheet_id = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
-    if not spreadsheet_id:
-        raise ValueError("Falta GOOGLE_SHEETS_SPREADSHEET_ID")
+def fetch_appointments(sheets_service) -> List[Dict]:
+    ensure_sheet_headers(sheets_service)
+    (rows,) = batch_get_values(sheets_service, [APPOINTMENTS_RANGE])
+    # Sheets omite las celdas vacías al final de la fila; se completan con "".
+    padding = [""] * len(HEADERS)
+    return [dict(zip(HEADERS, row + padding[len(row) :])) for row in rows]
+
+
+@st.cache_data(ttl=FETCH_TTL_SECONDS, show_spinner=False)
+def _cached_fetch(spreadsheet_id: str) -> List[Dict]:
+    """Lee las citas con cache por TTL; el servicio se obtiene adentro."""
+
+    _, sheets_service = get_google_services()
+    return fetch_appointments(sheets_service)
+
+
+def load_appointments(spreadsheet_id: str) -> AppointmentsIndex:
+    # cache_data guarda solo filas planas; AppointmentsIndex vive en el __main__
+    # de cada rerun y no se puede picklear entre sesiones, así que se arma aquí.
+    return build_appointments_index(_cached_fetch(spreadsheet_id))
+
 
+def invalidate_appointments_cache() -> None:
+    _cached_fetch.clear()
+
+
+def append_appointment(sheets_service, values: List[str]) -> None:
     ensure_sheet_headers(sheets_service)
     sheets_service.spreadsheets().values().append(
-        spreadsheetId=spreadsheet_id,
+        spreadsheetId=SPREADSHEET_ID,
         range=f"{SHEET_NAME}!A1",
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
         body={"values": [values]},
     ).execute()
+    invalidate_appointments_cache()
+
+
+def confirm_row_number(sheets_service, appointment_id: str, idx: int) -> int:
+    """Número de fila actual de la cita antes de sobrescribirla.
+
+    idx viene del snapshot cacheado; si la hoja se reordenó o se borraron filas
+    desde entonces, se vuelve a leer para no pisar la cita de otro paciente.
+    """
+
+    row_number = idx + 2
+    (cells,) = batch_get_values(sheets_service, [f"{SHEET_NAME}!A{row_number}"])
+    if cells and cells[0] and cells[0][0] == appointment_id:
+        return row_number
+    invalidate_appointments_cache()
+    for pos, item in enumerate(fetch_appointments(sheets_service)):
+        if item.get("id") == appointment_id:
+            return pos + 2
+    raise ValueError("La cita ya no está en la hoja. Actualiza la agenda.")
 
 
 def update_row(sheets_service, row_number: int, values: List[str]) -> None:
-    spreadsheet_id = os.getenv("GOOGLE_SHEETS_SPREADSHEET_ID", "")
-    if not spreadsheet_id:
-        raise ValueError("Falta GOOGLE_SHEETS_SPREADSHEET_ID")
+    update_rows(sheets_service, {row_number: values})
 
-    range_ref = f"{SHEET_NAME}!A{row_number}:L{row_number}"
-    sheets_service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=range_ref,
-        valueInputOption="USER_ENTERED",
-        body={"values": [values]},
+
+def update_rows(sheets_service, rows: Dict[int, List[str]]) -> None:
+    """Escribe varias filas en una sola llamada a values.batchUpdate."""
+
+    if not rows:
+        return
+
+    data = [
+        {"range": f"{SHEET_NAME}!A{row_number}:L{row_number}", "values": [values]}
+        for row_number, values in rows.items()
+    ]
+    sheets_service.spreadsheets().values().batchUpdate(
+        spreadsheetId=SPREADSHEET_ID,
+        body={"valueInputOption": "USER_ENTERED", "data": data},
     ).execute()
+    invalidate_appointments_cache()
+
+
+def _connect_smtp(user: str, password: str) -> smtplib.SMTP:
+    context = ssl.create_default_context()
+    try:
+        server = smtplib.SMTP_SSL(SMTP_HOST, 465, context=context, timeout=30)
+        return _login_smtp(server, user, password)
+    except ssl.SSLEOFError:
+        # Fallback a STARTTLS si el túnel SSL directo falla (EOF).
+        server = smtplib.SMTP(SMTP_HOST, 587, timeout=30)
+        return _login_smtp(server, user, password, starttls=context)
+
+
+def _login_smtp(
+    server: smtplib.SMTP,
+    user: str,
+    password: str,
+    starttls: Optional[ssl.SSLContext] = None,
+) -> smtplib.SMTP:
+    """Autentica la conexión recién abierta; si falla, cierra el socket."""
+
+    try:
+        if starttls is not None:
+            server.ehlo()
+            server.starttls(context=starttls)
+            server.ehlo()
+        server.login(user, password)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+@st.cache_resource(show_spinner=False)
+def _smtp_conn(user: str, password: str) -> smtplib.SMTP:
+    """Conexión SMTP autenticada que se mantiene abierta entre envíos."""
+
+    return _connect_smtp(user, password)
+
+
+def _get_smtp(user: str, password: str) -> smtplib.SMTP:
+    """Reutiliza la conexión SMTP abierta; reconecta si el servidor la cerró."""
+
+    server = _smtp_conn(user, password)
+    try:
+        if server.noop()[0] == 250:
+            return server
+    except (smtplib.SMTPException, OSError):
+        pass
+    _drop_smtp(server)
+    return _smtp_conn(user, password)
+
+
+def _drop_smtp(server: smtplib.SMTP) -> None:
+    _smtp_conn.clear()
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
 
 
 def send_email(to_email: str, subject: str, body: str) -> None:
-    user = os.getenv("GMAIL_USER")
-    password = os.getenv("GMAIL_APP_PASSWORD")
-    if not user or not password:
+    """Valida y encola el correo; el envío SMTP ocurre en segundo plano."""
+
+    if not GMAIL_USER or not GMAIL_APP_PASSWORD:
         st.warning(
             "No se configuró GMAIL_USER o GMAIL_APP_PASSWORD. Correo no enviado."
         )
@@ -458,27 +545,30 @@ def send_email(to_email: str, subject: str, body: str) -> None:
 
     msg = EmailMessage()
     msg["Subject"] = subject
-    msg["From"] = user
+    msg["From"] = GMAIL_USER
     msg["To"] = to_email
     msg.set_content(body)
 
-    context = ssl.create_default_context()
+    get_email_executor().submit(_deliver_email, msg, GMAIL_USER, GMAIL_APP_PASSWORD)
+
+
+def _deliver_email(msg: EmailMessage, user: str, password: str) -> None:
+    # Corre en get_email_executor() (un hilo, fuera del rerun): no hay envíos
+    # concurrentes y los errores van al log porque la UI ya respondió.
+    server: Optional[smtplib.SMTP] = None
     try:
-        with smtplib.SMTP_SSL(
-            "smtp.gmail.com", 465, context=context, timeout=30
-        ) as server:
-            server.login(user, password)
+        server = _get_smtp(user, password)
+        try:
             server.send_message(msg)
-    except ssl.SSLEOFError:
-        # Fallback a STARTTLS si el túnel SSL directo falla (EOF).
-        with smtplib.SMTP("smtp.gmail.com", 587, timeout=30) as server:
-            server.ehlo()
-            server.starttls(context=context)
-            server.ehlo()
-            server.login(user, password)
+        except smtplib.SMTPServerDisconnected:
+            # La conexión reutilizada pudo cerrarse entre el noop y el envío.
+            _drop_smtp(server)
+            server = _get_smtp(user, password)
             server.send_message(msg)
-    except Exception as exc:  # noqa: BLE001
-        st.error(f"Error al enviar correo: {exc}")
+    except Exception:  # noqa: BLE001
+        if server is not None:
+            _drop_smtp(server)
+        logger.exception("Error al enviar correo a %s", msg["To"])
 
 
 def email_subject() -> str:
@@ -489,8 +579,8 @@ def email_body_created(name: str, appointment_id: str, start_dt: datetime) -> st
     return (
         f"Hola {name or 'usuario'},\n\n"
         f"Tu cita con ID {appointment_id} ha sido creada exitosamente.\n\n"
-        f"Fecha: {start_dt.strftime('%Y-%m-%d')}\n"
-        f"Hora: {start_dt.strftime('%I:%M %p (%Z)')}\n\n"
+        f"Fecha: {start_dt.date().isoformat()}\n"
+        f"Hora: {format_clock(start_dt)} ({start_dt.tzname()})\n\n"
         "Gracias por cuidar tu salud visual con nosotros."
     )
 
@@ -499,8 +589,8 @@ def email_body_updated(name: str, appointment_id: str, start_dt: datetime) -> st
     return (
         f"Hola {name or 'usuario'},\n\n"
         f"Tu cita con ID {appointment_id} ha sido reprogramada.\n\n"
-        f"Nueva fecha: {start_dt.strftime('%Y-%m-%d')}\n"
-        f"Nueva hora: {start_dt.strftime('%I:%M %p (%Z)')}\n\n"
+        f"Nueva fecha: {start_dt.date().isoformat()}\n"
+        f"Nueva hora: {format_clock(start_dt)} ({start_dt.tzname()})\n\n"
         "Gracias por cuidar tu salud visual con nosotros."
     )
 
@@ -521,13 +611,12 @@ def create_calendar_event(
     duration_minutes: int,
     attendee: Optional[str] = None,
 ) -> str:
-    calendar_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
     event_body = {
         "summary": summary,
-        "start": {"dateTime": start_dt.isoformat(), "timeZone": str(tz)},
+        "start": {"dateTime": start_dt.isoformat(), "timeZone": TZ_NAME},
         "end": {
             "dateTime": (start_dt + timedelta(minutes=duration_minutes)).isoformat(),
-            "timeZone": str(tz),
+            "timeZone": TZ_NAME,
         },
     }
     if attendee and not DISABLE_ATTENDEE_INVITES:
@@ -535,7 +624,7 @@ def create_calendar_event(
     event = (
         calendar_service.events()
         .insert(
-            calendarId=calendar_id,
+            calendarId=CALENDAR_ID,
             body=event_body,
             sendUpdates="none" if DISABLE_ATTENDEE_INVITES else "all",
         )
@@ -551,18 +640,17 @@ def update_calendar_event(
     duration_minutes: int,
     attendee: Optional[str] = None,
 ) -> None:
-    calendar_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
     body = {
-        "start": {"dateTime": start_dt.isoformat(), "timeZone": str(tz)},
+        "start": {"dateTime": start_dt.isoformat(), "timeZone": TZ_NAME},
         "end": {
             "dateTime": (start_dt + timedelta(minutes=duration_minutes)).isoformat(),
-            "timeZone": str(tz),
+            "timeZone": TZ_NAME,
         },
     }
     if attendee and not DISABLE_ATTENDEE_INVITES:
         body["attendees"] = [{"email": attendee}]
     calendar_service.events().patch(
-        calendarId=calendar_id,
+        calendarId=CALENDAR_ID,
         eventId=event_id,
         body=body,
         sendUpdates="none" if DISABLE_ATTENDEE_INVITES else "all",
@@ -570,40 +658,35 @@ def update_calendar_event(
 
 
 def delete_calendar_event(calendar_service, event_id: str) -> None:
-    calendar_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
     calendar_service.events().delete(
-        calendarId=calendar_id, eventId=event_id, sendUpdates="all"
+        calendarId=CALENDAR_ID, eventId=event_id, sendUpdates="all"
     ).execute()
 
 
 def format_local(dt_value: datetime) -> str:
-    return dt_value.strftime("%Y-%m-%d %I:%M %p (%Z)")
+    """Equivale a strftime("%Y-%m-%d %I:%M %p (%Z)")."""
 
+    day = dt_value.date().isoformat()
+    return f"{day} {format_clock(dt_value)} ({dt_value.tzname()})"
 
-def has_conflict(
-    existing: List[Dict], target_iso: str, ignore_id: Optional[str] = None
-) -> bool:
-    for item in existing:
-        if item.get("status") != "active":
-            continue
-        if ignore_id and item.get("id") == ignore_id:
-            continue
-        if item.get("start_time_iso") == target_iso:
-            return True
-    return False
+
+def has_conflict(index: Dict[date, set], start_dt: datetime) -> bool:
+    """Busca el horario en el mismo índice que colorea fechas y slots."""
+
+    return slot_key(start_dt) in index.get(start_dt.date(), ())
 
 
 def find_by_id(
-    existing: List[Dict], appointment_id: str
+    appointments: AppointmentsIndex, appointment_id: str
 ) -> Tuple[Optional[Dict], Optional[int]]:
-    for idx, item in enumerate(existing):
-        if item.get("id") == appointment_id:
-            return item, idx
-    return None, None
+    idx = appointments.by_id.get(appointment_id)
+    if idx is None:
+        return None, None
+    return appointments.rows[idx], idx
 
 
-def filter_by_email(existing: List[Dict], email: str) -> List[Dict]:
-    return [item for item in existing if item.get("email", "").lower() == email.lower()]
+def filter_by_email(appointments: AppointmentsIndex, email: str) -> List[Dict]:
+    return appointments.by_email.get(email.casefold(), [])
 
 
 def render_header():
@@ -613,7 +696,7 @@ def render_header():
     )
 
 
-def handle_booking(existing: List[Dict]) -> None:
+def handle_booking(appointments: AppointmentsIndex) -> None:
     with st.form("book_form"):
         name = st.text_input("Nombre", max_chars=80)
         email = st.text_input("Email")
@@ -629,7 +712,7 @@ def handle_booking(existing: List[Dict]) -> None:
             max_value=max_birthdate,
             format="YYYY-MM-DD",
         )
-        date_choices, default_idx = date_choice_list(date.today(), existing)
+        date_choices, default_idx = date_choice_list(date.today(), appointments.by_date)
         selected_date_choice = st.selectbox(
             "Fecha",
             options=date_choices,
@@ -643,19 +726,19 @@ def handle_booking(existing: List[Dict]) -> None:
             st.error("No se permite agendar domingos ni festivos en Colombia.")
             submitted = st.form_submit_button("Agendar cita")
             return
-        slots_info = slot_choices(existing, selected_date)
+        slots_info = slot_choices(appointments.by_date, selected_date)
         selected_slot_info = st.selectbox(
             "Hora",
             options=slots_info,
-            format_func=lambda item: item["label"],
+            format_func=lambda item: item.label,
             key=f"slot_booking_{selected_date.isoformat()}",
             help=(
                 "Slots de 15 minutos en 8am-12pm y 2pm-6pm "
                 "(🟢 disponibles / 🔴 ocupados)"
             ),
         )
-        if selected_slot_info and selected_slot_info["status"] == "free":
-            selected_slot = selected_slot_info["dt"]
+        if selected_slot_info and selected_slot_info.status == "free":
+            selected_slot = selected_slot_info.dt
         else:
             selected_slot = None
             st.warning("Selecciona un horario disponible (verde).")
@@ -713,7 +796,7 @@ def handle_booking(existing: List[Dict]) -> None:
         return
 
     start_iso = start_dt.isoformat()
-    if has_conflict(existing, start_iso):
+    if has_conflict(appointments.by_date, start_dt):
         st.error("Ya existe una cita en ese horario.")
         return
 
@@ -749,7 +832,15 @@ def handle_booking(existing: List[Dict]) -> None:
             created_at,
             "",
         ]
-        append_appointment(sheets_service, values)
+        try:
+            append_appointment(sheets_service, values)
+        except Exception:
+            # Sin fila en la hoja el evento quedaría huérfano bloqueando el slot.
+            try:
+                delete_calendar_event(calendar_service, event_id)
+            except Exception:  # noqa: BLE001
+                logger.exception("No se pudo revertir el evento %s", event_id)
+            raise
 
         email_body = email_body_created(name, appointment_id, start_dt)
         send_email(email, email_subject(), email_body)
@@ -758,22 +849,23 @@ def handle_booking(existing: List[Dict]) -> None:
         st.error(f"Error al agendar: {exc}")
 
 
-def handle_lookup(existing: List[Dict]) -> List[Dict]:
+def handle_lookup(appointments: AppointmentsIndex) -> List[Dict]:
     st.subheader("Mis citas")
     email = st.text_input("Email para consultar")
     if not email:
         return []
-    user_rows = filter_by_email(existing, email)
+    user_rows = filter_by_email(appointments, email)
     active = [row for row in user_rows if row.get("status") == "active"]
     if active:
-        df = pd.DataFrame(active)
-        st.dataframe(df[["id", "local_display", "status", "notes"]])
+        st.dataframe(
+            [{col: row.get(col, "") for col in LOOKUP_COLUMNS} for row in active]
+        )
     else:
         st.info("No hay citas activas para este email.")
     return active
 
 
-def handle_update(existing: List[Dict], user_rows: List[Dict]) -> None:
+def handle_update(appointments: AppointmentsIndex, user_rows: List[Dict]) -> None:
     st.subheader("Actualizar cita")
     if not user_rows:
         st.caption("Ingresa un email arriba para ver tus citas.")
@@ -784,9 +876,9 @@ def handle_update(existing: List[Dict], user_rows: List[Dict]) -> None:
     if not selected_id:
         return
 
-    date_choices, default_idx = date_choice_list(
-        date.today(), existing, ignore_id=selected_id
-    )
+    # Índice sin la cita que se está moviendo: su horario actual queda libre.
+    update_index = index_appointments(appointments.rows, ignore_id=selected_id)
+    date_choices, default_idx = date_choice_list(date.today(), update_index)
     selected_date_choice = st.selectbox(
         "Nueva fecha",
         options=date_choices,
@@ -801,18 +893,18 @@ def handle_update(existing: List[Dict], user_rows: List[Dict]) -> None:
         st.error("No se permite agendar domingos ni festivos en Colombia.")
         return
 
-    slots_info = slot_choices(existing, selected_date, ignore_id=selected_id)
+    slots_info = slot_choices(update_index, selected_date)
     selected_slot_info = st.selectbox(
         "Nueva hora",
         options=slots_info,
-        format_func=lambda item: item["label"],
+        format_func=lambda item: item.label,
         key=f"update_time_{selected_id}_{selected_date.isoformat()}",
         help=(
             "Slots de 15 minutos en 8am-12pm y 2pm-6pm (🟢 disponibles / 🔴 ocupados)"
         ),
     )
-    if selected_slot_info and selected_slot_info["status"] == "free":
-        selected_slot = selected_slot_info["dt"]
+    if selected_slot_info and selected_slot_info.status == "free":
+        selected_slot = selected_slot_info.dt
     else:
         selected_slot = None
         st.warning("Selecciona un horario disponible (verde).")
@@ -831,17 +923,18 @@ def handle_update(existing: List[Dict], user_rows: List[Dict]) -> None:
             return
 
         start_iso = start_dt.isoformat()
-        if has_conflict(existing, start_iso, ignore_id=selected_id):
+        if has_conflict(update_index, start_dt):
             st.error("Ya existe una cita en ese horario.")
             return
 
-        target, idx = find_by_id(existing, selected_id)
+        target, idx = find_by_id(appointments, selected_id)
         if not target or idx is None:
             st.error("No se encontró la cita.")
             return
 
         try:
             calendar_service, sheets_service = get_google_services()
+            row_number = confirm_row_number(sheets_service, selected_id, idx)
             event_id = target.get("calendar_event_id", "")
             if calendar_has_conflict(
                 calendar_service,
@@ -875,7 +968,7 @@ def handle_update(existing: List[Dict], user_rows: List[Dict]) -> None:
                 target.get("created_at_iso", target.get("created_at", "")),
                 notes or target.get("notes", ""),
             ]
-            update_row(sheets_service, idx + 2, updated_row)
+            update_row(sheets_service, row_number, updated_row)
 
             email_body = email_body_updated(
                 target.get("name", ""), selected_id, start_dt
@@ -886,7 +979,7 @@ def handle_update(existing: List[Dict], user_rows: List[Dict]) -> None:
             st.error(f"Error al actualizar: {exc}")
 
 
-def handle_cancel(existing: List[Dict], user_rows: List[Dict]) -> None:
+def handle_cancel(appointments: AppointmentsIndex, user_rows: List[Dict]) -> None:
     st.subheader("Cancelar cita")
     if not user_rows:
         st.caption("Ingresa un email arriba para ver tus citas.")
@@ -896,13 +989,14 @@ def handle_cancel(existing: List[Dict], user_rows: List[Dict]) -> None:
     selected_id = st.selectbox("Selecciona la cita a cancelar", ids, key="cancel_id")
     reason = st.text_input("Motivo de cancelación")
     if st.button("Cancelar cita"):
-        target, idx = find_by_id(existing, selected_id)
+        target, idx = find_by_id(appointments, selected_id)
         if not target or idx is None:
             st.error("No se encontró la cita.")
             return
 
         try:
             calendar_service, sheets_service = get_google_services()
+            row_number = confirm_row_number(sheets_service, selected_id, idx)
             event_id = target.get("calendar_event_id", "")
             if event_id:
                 delete_calendar_event(calendar_service, event_id)
@@ -921,7 +1015,7 @@ def handle_cancel(existing: List[Dict], user_rows: List[Dict]) -> None:
                 target.get("created_at_iso", target.get("created_at", "")),
                 reason,
             ]
-            update_row(sheets_service, idx + 2, canceled_row)
+            update_row(sheets_service, row_number, canceled_row)
 
             email_body = email_body_canceled(
                 target.get("name", ""), selected_id, reason
@@ -935,11 +1029,14 @@ def handle_cancel(existing: List[Dict], user_rows: List[Dict]) -> None:
 def main():
     render_header()
 
+    if st.button("Actualizar agenda"):
+        invalidate_appointments_cache()
+
     try:
-        _, sheets_service = get_google_services()
-        appointments = fetch_appointments(sheets_service)
+        validate_config()
+        appointments = load_appointments(SPREADSHEET_ID)
     except Exception as exc:  # noqa: BLE001
-        appointments = []
+        appointments = build_appointments_index([])
         st.warning(
             f"Configura Google APIs para habilitar agenda persistente. Detalle: {exc}"
         )